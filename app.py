@@ -1,141 +1,728 @@
 # app.py — FastAPI + yt-dlp
 # /api?url=... → JSON (проксированный URL через воркер)
 # /dl?url=...  → поток через воркер (200/206 + Range), читабельное имя файла
+# /r?url=...   → 302 на проксированный URL (то же, что /dl?redirect=1)
 # ВАЖНО: задайте переменную окружения PROXY_BASE = https://<имя>.workers.dev
 
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse, Response
-import yt_dlp
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+from cachetools import TLRUCache, TTLCache
 import httpx
+import orjson
+import anyio
+import asyncio
+import functools
+import hashlib
 import os
 import re
-from urllib.parse import quote as urlquote
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.parse import quote as urlquote, urlsplit, urlunsplit, parse_qsl, urlencode
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sweep_cache_dir()
+    yield
+    for task in list(_PREFETCH.values()):
+        task.cancel()
+    await CLIENT.aclose()
+    if REDIS is not None:
+        await REDIS.aclose()
+    YDL_POOL.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 PROXY_BASE = os.getenv("PROXY_BASE", "").rstrip("/")
 if not PROXY_BASE:
     raise RuntimeError('Set env var PROXY_BASE = "https://<name>.workers.dev"')
 
+# Размер куска при пересылке тела: крупные куски = меньше yield/ASGI send на мегабайт
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(1 << 20)))
+
+# Одновременных стримов с CDN не больше MAX_STREAMS: каждый держит соединение
+# апстрима, буферы и сокет. Сверх лимита /dl сразу отвечает 503
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", "64"))
+_STREAM_SEM = asyncio.Semaphore(MAX_STREAMS)
+
+# Локальный кэш целиком скачанных роликов: повторные Range-запросы плеера
+# читаются с диска, а не снова с CDN
+CACHE_DIR = os.getenv("CACHE_DIR") or os.path.join(tempfile.gettempdir(), "tiktok-proxy")
+BODY_CACHE_BYTES = int(os.getenv("BODY_CACHE_BYTES", str(1 << 30)))
+PREFETCH_MAX_BYTES = int(os.getenv("PREFETCH_MAX_BYTES", str(64 << 20)))
+os.makedirs(CACHE_DIR, exist_ok=True)
+
 UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
     "(KHTML, like Gecko) Chrome/124 Safari/537.36"
 )
 
-BASE_HEADERS = {
+# Заранее нормализованные заголовки: httpx не пересобирает их на каждый запрос
+BASE_HEADERS = httpx.Headers({
     "User-Agent": UA,
     "Accept": "*/*",
+    # тело отдаём как есть (aiter_raw), поэтому сжатие у апстрима не просим
+    "Accept-Encoding": "identity",
     "Accept-Language": "en-US,en;q=0.9,ru-RU;q=0.8,ru;q=0.7",
     "Connection": "keep-alive",
+})
+
+# Один клиент на процесс: keep-alive/HTTP2-пул к воркеру переживает запросы,
+# TLS-рукопожатие не повторяется на каждый /dl.
+# Куки не храним — иначе общий jar делился бы между пользователями.
+# TCP_NODELAY — без задержек Nagle на границах кусков. Входящие сокеты
+# uvicorn (asyncio/uvloop) получают NODELAY от самого event loop.
+CLIENT = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60),
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+    ),
+    follow_redirects=True,
+    timeout=120,
+    headers=BASE_HEADERS,
+    cookies=httpx.Cookies(CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))),
+)
+
+# Отдельный пул под yt-dlp: блокирующий extract не занимает event loop
+# и общий threadpool FastAPI/Starlette. Небольшой размер пула заодно
+# ограничивает число одновременных заходов в TikTok.
+YDL_WORKERS = int(os.getenv("YDL_WORKERS", "4"))
+YDL_POOL = ThreadPoolExecutor(max_workers=YDL_WORKERS, thread_name_prefix="ydl")
+
+# Кэш результатов yt-dlp: ключ — id видео (или нормализованный URL, если id
+# в ссылке нет), значение — (vurl, title, Content-Disposition). Запись живёт
+# не дольше EXTRACT_TTL и не дольше срока подписи ссылки CDN (expire=/x-expires=).
+EXTRACT_TTL = int(os.getenv("EXTRACT_CACHE_TTL", "300"))
+EXTRACT_CACHE_SIZE = int(os.getenv("EXTRACT_CACHE_SIZE", "1024"))
+_VID_RE = re.compile(r"/video/(\d+)")
+# Принимаем только ссылки TikTok — остальное отсекаем до yt-dlp
+_TIKTOK_RE = re.compile(r"^https?://(?:www\.|vm\.|vt\.|m\.)?tiktok\.com/", re.I)
+_EXPIRE_RE = re.compile(r"[?&](?:x-)?expires?=(\d+)")
+
+def _entry_ttl(vurl: str) -> float:
+    ttl = EXTRACT_TTL
+    m = _EXPIRE_RE.search(vurl)
+    if m:
+        # запас 30 с, чтобы не отдать ссылку, которая протухнет на лету
+        ttl = min(ttl, int(m.group(1)) - time.time() - 30)
+    return ttl
+
+def _entry_ttu(key, value, now):
+    return now + _entry_ttl(value[0])
+
+EXTRACT_CACHE: TLRUCache = TLRUCache(maxsize=EXTRACT_CACHE_SIZE, ttu=_entry_ttu)
+# Singleflight: extract по ключу идёт одной отдельной задачей, все запросы
+# (и первый тоже) ждут её результат или ошибку. Ушедший клиент не отменяет
+# задачу — остальные получат ответ, а он сам ляжет в кэш.
+_INFLIGHT: dict[str, asyncio.Task] = {}
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+class BodyCache(TTLCache):
+    # значение — (path, size, content-disposition); вытеснение и истечение
+    # записи удаляют и сам файл
+    def popitem(self):
+        key, entry = super().popitem()
+        _unlink(entry[0])
+        return key, entry
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, entry in expired:
+            _unlink(entry[0])
+        return expired
+
+BODY_TTL = 3600
+BODY_CACHE = BodyCache(maxsize=BODY_CACHE_BYTES, ttl=BODY_TTL, getsizeof=lambda e: e[1])
+_PREFETCH: dict[str, asyncio.Task] = {}
+# Фоновых докачек одновременно не больше MAX_PREFETCH — каждая держит свой GET к CDN
+MAX_PREFETCH = int(os.getenv("MAX_PREFETCH", "4"))
+# Ключи, чьё тело прямо сейчас пишется на диск (tee живого стрима или prefetch)
+_FILLING: set[str] = set()
+
+def sweep_cache_dir() -> None:
+    # Файлы от прошлых запусков: записи BODY_CACHE о них уже нет. Удаляем
+    # только то, что старше BODY_TTL, — CACHE_DIR может быть общим у воркеров
+    cutoff = time.time() - BODY_TTL
+    for entry in os.scandir(CACHE_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+class BodySink:
+    # .part-файл в CACHE_DIR; в BODY_CACHE попадает только дописанный целиком.
+    # Открытие и закрытие синхронные — их нельзя прервать отменой задачи.
+    def __init__(self, key: str, size: int, cd: str):
+        self.key, self.size, self.cd = key, size, cd
+        self.path = os.path.join(CACHE_DIR, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".mp4")
+        self.part = f"{self.path}.{os.getpid()}.{id(self):x}.part"
+        self.file = anyio.wrap_file(open(self.part, "wb"))
+        self.written = 0
+
+    @classmethod
+    def create(cls, key: str, size: int, cd: str) -> "BodySink | None":
+        if not size or size > PREFETCH_MAX_BYTES or key in _FILLING or key in BODY_CACHE:
+            return None
+        try:
+            sink = cls(key, size, cd)
+        except OSError:
+            return None
+        _FILLING.add(key)
+        return sink
+
+    async def write(self, chunk: bytes) -> None:
+        await self.file.write(chunk)
+        self.written += len(chunk)
+
+    def close(self) -> None:
+        _FILLING.discard(self.key)
+        try:
+            self.file.wrapped.close()
+            if self.written == self.size:
+                os.replace(self.part, self.path)
+                BODY_CACHE[self.key] = (self.path, self.size, self.cd)
+        except OSError:
+            pass
+        finally:
+            _unlink(self.part)
+
+# Общий для всех воркеров/контейнеров слой кэша (необязательный): при
+# uvicorn --workers N каждый процесс иначе ходил бы в TikTok сам
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    # Короткие таймауты: зависший Redis не должен держать извлечение
+    REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+    REDIS = aioredis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+else:
+    REDIS = None
+
+# Параметры шаринга/трекинга, которые не влияют на видео
+TRACKING_PARAMS = frozenset({
+    "_r", "_t", "_d", "is_from_webapp", "is_copy_url", "sender_device", "sender_web_id",
+    "web_id", "share_app_id", "share_item_id", "share_link_id", "social_share_type",
+    "timestamp", "u_code", "user_id", "sec_user_id", "source", "tt_from", "checksum",
+    "preview_pb", "enter_from", "refer", "lang", "language",
+})
+
+# Страницу TikTok берём сжатой, в отличие от видео
+PAGE_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Referer": "https://www.tiktok.com/",
 }
+# Состояние страницы целиком: ItemModule → {id: {desc, video: {playAddr, ...}}}
+# (SIGI_STATE) или __DEFAULT_SCOPE__ → webapp.video-detail → itemInfo.itemStruct
+_UNIVERSAL = re.compile(rb'<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__"[^>]*>(.*?)</script>', re.S)
+_SIGI = re.compile(rb'<script id="SIGI_STATE"[^>]*>(.*?)</script>', re.S)
 
 def pick_format(info: dict) -> str | None:
-    fmts = info.get("formats") or []
-    def score(f):
-        s = 0
-        if f.get("ext") == "mp4": s += 10
-        v = (f.get("vcodec") or "")
-        if v.startswith("avc") or v.startswith("h264"): s += 5
-        s += f.get("height") or 0
-        return s
-    best = max(fmts, key=score, default=None)
+    # один проход: mp4 +10, h264/avc +5, плюс высота. mp4/h264 от 720p —
+    # это потолок TikTok, дальше не ищем
+    best, best_s = None, -1
+    for f in info.get("formats") or ():
+        g = f.get
+        h = g("height") or 0
+        mp4 = g("ext") == "mp4"
+        avc = (g("vcodec") or "").startswith(("avc", "h264"))
+        s = h + (10 if mp4 else 0) + (5 if avc else 0)
+        if s > best_s:
+            best, best_s = f, s
+            if mp4 and avc and h >= 720:
+                break
     return (best or info).get("url")
 
+YDL_OPTS = {
+    "quiet": True,
+    "noplaylist": True,
+    "geo_bypass": True,
+    "nocheckcertificate": True,
+    # формат выбирает сам yt-dlp: mp4 с h264, иначе любой mp4, иначе лучший
+    "format": "best[ext=mp4][vcodec^=avc]/best[ext=mp4][vcodec^=h264]/best[ext=mp4]/best",
+    "extract_flat": False,
+    "http_headers": {
+        "User-Agent": UA,
+        "Referer": "https://www.tiktok.com/",
+        "Origin": "https://www.tiktok.com",
+    },
+}
+_YDL_LOCAL = threading.local()
+
+def _ydl():
+    # Один YoutubeDL на поток YDL_POOL: опции, экстракторы и сессия
+    # создаются один раз, а не на каждый вызов. Между потоками не делим —
+    # YoutubeDL не потокобезопасен
+    ydl = getattr(_YDL_LOCAL, "ydl", None)
+    if ydl is None:
+        # yt-dlp тянет сотни модулей — импортируем только когда он реально нужен
+        import yt_dlp
+        ydl = _YDL_LOCAL.ydl = yt_dlp.YoutubeDL(YDL_OPTS)
+    return ydl
+
 def extract(url: str):
-    ydl_opts = {
-        "quiet": True,
-        "noplaylist": True,
-        "geo_bypass": True,
-        "nocheckcertificate": True,
-        "http_headers": {
-            "User-Agent": UA,
-            "Referer": "https://www.tiktok.com/",
-            "Origin": "https://www.tiktok.com",
-        },
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    ydl = _ydl()
+    # сразу нужный экстрактор, без перебора всех (включая generic)
+    ie_key = next((k for k in ("TikTok", "TikTokVM") if ydl.get_info_extractor(k).suitable(url)), None)
+    info = ydl.extract_info(url, download=False, ie_key=ie_key)
 
-    vurl = pick_format(info)
+    # url выбранного формата лежит прямо в info; pick_format — на случай, если нет
+    vurl = info.get("url") or pick_format(info)
     title = info.get("title")
-    return vurl, title
+    return vurl, title, info.get("id")
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith("utm_")
+    ]
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ""))
+
+def cache_key(url: str) -> str:
+    # короткие vm.tiktok.com и полные ссылки на одно видео делят одну запись
+    m = _VID_RE.search(url)
+    return f"id:{m.group(1)}" if m else normalize_url(url)
+
+def _redis_key(key: str) -> str:
+    return "tp:" + hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+async def shared_get(key: str) -> tuple[str, str | None, str] | None:
+    # Redis — только ускоритель: любая его ошибка = промах
+    if REDIS is None:
+        return None
+    try:
+        raw = await REDIS.get(_redis_key(key))
+        entry = orjson.loads(raw) if raw else None
+    except Exception:
+        return None
+    # записи старого формата (vurl, title) и прочий мусор считаем промахом
+    if not isinstance(entry, list) or len(entry) != 3 or not isinstance(entry[0], str):
+        return None
+    return tuple(entry)
+
+async def shared_set(keys: list[str], entry: tuple[str, str | None, str]) -> None:
+    ttl = int(_entry_ttl(entry[0]))
+    if REDIS is None or ttl <= 0:
+        return
+    value = orjson.dumps(entry)
+    try:
+        async with REDIS.pipeline(transaction=False) as pipe:
+            for k in keys:
+                pipe.set(_redis_key(k), value, ex=ttl)
+            await pipe.execute()
+    except Exception:
+        pass
+
+async def shared_delete(keys: list[str]) -> None:
+    if REDIS is None:
+        return
+    try:
+        await REDIS.delete(*map(_redis_key, keys))
+    except Exception:
+        pass
+
+async def _extract(url: str, key: str, use_page: bool = True):
+    # use_page=False — ссылку со страницы CDN уже отверг (403): Redis и
+    # страницу пропускаем, идём сразу в yt-dlp, его ответ заменит плохую запись
+    vurl = None
+    if use_page:
+        entry = await shared_get(key)
+        if entry is not None:
+            EXTRACT_CACHE[key] = entry
+            return entry
+        vurl, title, vid = await resolve(url)
+    if not vurl:
+        loop = asyncio.get_running_loop()
+        vurl, title, vid = await loop.run_in_executor(YDL_POOL, extract, url)
+    if not vurl:
+        return None, None, None
+    # заголовок имени файла считаем один раз — /dl берёт его готовым из кэша
+    entry = EXTRACT_CACHE[key] = (vurl, title, safe_filename(title)[2])
+    keys = [key]
+    if vid and f"id:{vid}" != key:
+        EXTRACT_CACHE[f"id:{vid}"] = entry
+        keys.append(f"id:{vid}")
+    await shared_set(keys, entry)
+    return entry
 
-def safe_filename(title: str | None) -> tuple[str, str]:
-    base = (title or "video").strip()
-    base = re.sub(r'[\\/*?:"<>|]+', "_", base)
-    base = re.sub(r"\s+", " ", base).strip()[:80] or "video"
+async def extract_cached(url: str, use_page: bool = True):
+    key = cache_key(url)
+    hit = EXTRACT_CACHE.get(key)
+    if hit is not None:
+        return hit
+    # к извлечению через страницу повторный (только yt-dlp) не присоединяется
+    flight = key if use_page else "ydl:" + key
+    task = _INFLIGHT.get(flight)
+    if task is None:
+        # между проверкой и записью нет await — замок не нужен
+        task = _INFLIGHT[flight] = asyncio.create_task(_extract(url, key, use_page))
+        task.add_done_callback(functools.partial(_inflight_done, flight))
+    return await asyncio.shield(task)
+
+def _inflight_done(key: str, task: asyncio.Task) -> None:
+    if _INFLIGHT.get(key) is task:
+        del _INFLIGHT[key]
+    # ждущих могло не остаться — без "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+def _page_item(page: bytes, vid: str | None) -> tuple[str | None, dict]:
+    # Нынешняя вёрстка: __UNIVERSAL_DATA_FOR_REHYDRATION__; старая — SIGI_STATE
+    m = _UNIVERSAL.search(page)
+    if m:
+        scope = orjson.loads(m.group(1))["__DEFAULT_SCOPE__"]
+        item = scope["webapp.video-detail"]["itemInfo"]["itemStruct"]
+        return item.get("id") or vid, item
+    m = _SIGI.search(page)
+    items = orjson.loads(m.group(1))["ItemModule"] if m else {}
+    if vid not in items:
+        vid = next(iter(items), None)
+    return vid, items.get(vid) or {}
+
+async def resolve(url: str) -> tuple[str | None, str | None, str | None]:
+    # Быстрый путь без yt-dlp: один GET страницы и JSON из неё.
+    # (vurl, title, id) или (None, None, None) — тогда нужен yt-dlp
+    try:
+        r = await CLIENT.get(url, headers=PAGE_HEADERS, timeout=10)
+        m = _VID_RE.search(str(r.url))
+        vid, item = _page_item(r.content, m.group(1) if m else None)
+        video = item.get("video") or {}
+        vurl = video.get("playAddr") or video.get("downloadAddr")
+    except (httpx.HTTPError, ValueError, LookupError, TypeError, AttributeError):
+        return None, None, None
+    if not vurl:
+        return None, None, None
+    return vurl, item.get("desc") or None, vid
+
+async def invalidate(url: str) -> None:
+    keys = [cache_key(url)]
+    stale = EXTRACT_CACHE.pop(keys[0], None)
+    if stale is not None:
+        # та же запись могла лежать и под вторым ключом (id / короткая ссылка)
+        keys += [k for k, v in EXTRACT_CACHE.items() if v is stale]
+        for k in keys[1:]:
+            EXTRACT_CACHE.pop(k, None)
+    await shared_delete(keys)
+
+# Запрещённые в имени файла символы → "_" (таблица для str.translate)
+_FN_BAD = str.maketrans({c: "_" for c in '\\/*?:"<>|'})
+_FN_WS = re.compile(r"\s+")
+_DEFAULT_FN = ("video.mp4", "video.mp4", "inline; filename=\"video.mp4\"; filename*=UTF-8''video.mp4")
+
+def safe_filename(title: str | None) -> tuple[str, str, str]:
+    # без названия — готовый ответ, мимо LRU
+    return _safe_filename(title) if title else _DEFAULT_FN
+
+@functools.lru_cache(maxsize=4096)
+def _safe_filename(title: str) -> tuple[str, str, str]:
+    base = title.strip().translate(_FN_BAD)
+    base = _FN_WS.sub(" ", base).strip()[:80] or "video"
     fn_utf8 = f"{base}.mp4"
     fn_ascii = fn_utf8.encode("ascii", "ignore").decode("ascii") or "video.mp4"
-    return fn_ascii, fn_utf8
+    # готовое значение Content-Disposition
+    cd = f'inline; filename="{fn_ascii}"; filename*=UTF-8\'\'{urlquote(fn_utf8)}'
+    return fn_ascii, fn_utf8, cd
 
 def proxied(url: str) -> str:
     return f"{PROXY_BASE}/tproxy?u={urlquote(url, safe='')}"
 
+# Заголовки апстрима, которые отдаём клиенту как есть
+# Тело идёт через aiter_raw как есть: если CDN всё же сожмёт ответ вопреки
+# Accept-Encoding: identity, клиент должен узнать об этом из content-encoding
+_PASS_HEADERS = frozenset((
+    b"content-length", b"content-range", b"accept-ranges", b"etag", b"last-modified", b"cache-control",
+    b"content-encoding",
+))
+
+async def close_upstream(upstream: httpx.Response) -> None:
+    # Отмена генератора (клиент ушёл) не должна прерывать закрытие, а зависшее
+    # закрытие — держать соединение: иначе оно не вернётся в пул CLIENT
+    try:
+        await asyncio.shield(asyncio.wait_for(upstream.aclose(), 5))
+    except Exception:
+        pass
+
+async def open_upstream(purl: str, headers: dict | None) -> httpx.Response:
+    req = CLIENT.build_request("GET", purl, headers=headers)
+    return await CLIENT.send(req, stream=True)
+
+_CRANGE_TOTAL = re.compile(r"/(\d+)\s*$")
+
+async def probe_length(purl: str) -> str | None:
+    # Range: bytes=0-0 → "Content-Range: bytes 0-0/<total>": размер без скачивания
+    # тела, работает и там, где воркер/CDN не отвечает на HEAD
+    try:
+        async with asyncio.timeout(3):
+            async with CLIENT.stream("GET", purl, headers={"Range": "bytes=0-0"}) as r:
+                if r.status_code == 206:
+                    m = _CRANGE_TOTAL.search(r.headers.get("content-range", ""))
+                    return m.group(1) if m else None
+                if r.status_code == 200:
+                    return r.headers.get("content-length")
+    except Exception:
+        pass
+    return None
+
+async def prefetch(key: str, purl: str, cd: str) -> None:
+    # Полная копия ролика в CACHE_DIR отдельным GET (когда сам клиент просит кусок)
+    try:
+        async with CLIENT.stream("GET", purl) as r:
+            if r.status_code != 200 or "content-encoding" in r.headers:
+                return
+            sink = BodySink.create(key, int(r.headers.get("content-length") or 0), cd)
+            if sink is None:
+                return
+            try:
+                async for chunk in r.aiter_raw(STREAM_CHUNK_BYTES):
+                    await sink.write(chunk)
+            finally:
+                sink.close()
+    except Exception:
+        pass
+
+def start_prefetch(key: str, purl: str, cd: str) -> None:
+    if len(_PREFETCH) >= MAX_PREFETCH or key in _PREFETCH or key in _FILLING or key in BODY_CACHE:
+        return
+    task = _PREFETCH[key] = asyncio.create_task(prefetch(key, purl, cd))
+    task.add_done_callback(lambda _: _PREFETCH.pop(key, None))
+
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+def parse_range(value: str | None, size: int) -> tuple[int, int] | None:
+    # (start, end) включительно; None — отдать целиком; ValueError — 416
+    m = _RANGE_RE.fullmatch(value.strip()) if value else None
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    else:
+        start, end = max(size - int(m.group(2)), 0), size - 1
+    if start > end:
+        raise ValueError("range not satisfiable")
+    # диапазон на весь файл (bytes=0-) — обычный 200, его кэши хранят охотнее
+    return None if (start, end) == (0, size - 1) else (start, end)
+
+async def serve_cached(request: Request, entry: tuple[str, int, str]) -> Response | None:
+    path, size, cd = entry
+    try:
+        rng = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    try:
+        f = await anyio.open_file(path, "rb")
+    except OSError:
+        return None
+    start, end = rng or (0, size - 1)
+
+    async def body():
+        try:
+            await f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = await f.read(min(STREAM_CHUNK_BYTES, left))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                yield chunk
+        finally:
+            await f.aclose()
+
+    headers = {
+        "Content-Disposition": cd,
+        "Content-Length": str(end - start + 1),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=86400",
+    }
+    if rng:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(body(), status_code=206 if rng else 200, media_type="video/mp4", headers=headers)
+
+async def redirect_response(url: str) -> Response:
+    # байты идут клиенту напрямую через воркер, мимо этого процесса
+    vurl, _, _ = await extract_cached(url)
+    if not vurl:
+        return ORJSONResponse({"ok": False, "error": "no_video"}, status_code=404)
+    # редирект живёт в чужих кэшах не дольше, чем мы сами верим подписи ссылки
+    max_age = max(int(_entry_ttl(vurl)), 0)
+    return RedirectResponse(
+        proxied(vurl), status_code=302, headers={"Cache-Control": f"public, max-age={max_age}"}
+    )
+
 @app.get("/")
 def root():
     return {"ok": True, "proxy": PROXY_BASE}
 
 @app.get("/api")
-def api(url: str):
+async def api(url: str, fields: str | None = None):
     try:
-        vurl, title = extract(url)
+        if not _TIKTOK_RE.match(url):
+            return ORJSONResponse({"ok": False, "error": "bad_url"}, status_code=400)
+        # extract_cached сам идёт кэш → страница TikTok → yt-dlp
+        vurl, title, _ = await extract_cached(url)
         if not vurl:
-            return JSONResponse({"ok": False, "error": "no_video"}, status_code=404)
+            return ORJSONResponse({"ok": False, "error": "no_video"}, status_code=404)
+        if fields == "url":
+            return {"ok": True, "video_url": proxied(vurl)}
         return {"ok": True, "video_url": proxied(vurl), "title": title}
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.get("/r")
+async def r(url: str):
+    try:
+        if not _TIKTOK_RE.match(url):
+            return ORJSONResponse({"ok": False, "error": "bad_url"}, status_code=400)
+        return await redirect_response(url)
+    except Exception as e:
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/dl")
-async def dl(request: Request, url: str):
+async def dl(request: Request, url: str, redirect: bool = False):
     try:
-        vurl, title = extract(url)
-        if not vurl:
-            return JSONResponse({"ok": False, "error": "no_video"}, status_code=404)
+        if not _TIKTOK_RE.match(url):
+            return ORJSONResponse({"ok": False, "error": "bad_url"}, status_code=400)
+        if redirect:
+            return await redirect_response(url)
+
+        # ролик уже целиком на диске — ни yt-dlp, ни CDN не нужны
+        key = cache_key(url)
+        entry = BODY_CACHE.get(key)
+        if entry is not None:
+            resp = await serve_cached(request, entry)
+            if resp is not None:
+                return resp
+
+        held = False
+        upstream = sink = None
+        handed_off = False
 
-        purl = proxied(vurl)
+        async def release():
+            # Слот, апстрим и .part-файл освобождаются ровно раз: из gen(), фоном
+            # после ответа (генератор, отменённый до первого чанка, свой finally
+            # не выполнит) или ниже, если до ответа дело не дошло
+            nonlocal held, upstream, sink
+            if held:
+                held = False
+                _STREAM_SEM.release()
+            if sink is not None:
+                sink.close()
+                sink = None
+            if upstream is not None:
+                up, upstream = upstream, None
+                await close_upstream(up)
 
-        headers = dict(BASE_HEADERS)
-        if "range" in request.headers:
-            headers["Range"] = request.headers["range"]
+        async def open_stream(purl: str) -> bool:
+            # Слот берём прямо перед GET и без await между проверкой и захватом:
+            # лимит считает открытые стримы, а не ждущие извлечения
+            nonlocal held, upstream
+            if _STREAM_SEM.locked():
+                return False
+            await _STREAM_SEM.acquire()
+            held = True
+            upstream = await open_upstream(purl, headers)
+            return True
 
-        async with httpx.AsyncClient(follow_redirects=True, timeout=120, headers=BASE_HEADERS) as client:
-            # HEAD к воркеру — чтобы узнать длину/тип (если отдаёт)
-            head = await client.head(purl)
-            clen = head.headers.get("content-length")
-            ctype = head.headers.get("content-type", "video/mp4")
+        try:
+            vurl, _, cd = await extract_cached(url)
+            if not vurl:
+                return ORJSONResponse({"ok": False, "error": "no_video"}, status_code=404)
+
+            purl = proxied(vurl)
+
+            # базовые заголовки подставляет сам CLIENT; свой словарь — только под Range
+            range_h = request.headers.get("range")
+            # "bytes=0-" — это весь файл. Апстриму шлём обычный GET и отвечаем 200:
+            # 206 фронтовые кэши (nginx, Cloudflare, mod_cache) не сохраняют
+            if range_h and range_h.strip().lower() == "bytes=0-":
+                range_h = None
+            headers = {"Range": range_h} if range_h else None
 
             # основной стрим (GET) с поддержкой Range
-            req = client.build_request("GET", purl, headers=headers)
-            upstream = await client.send(req, stream=True)
+            if not await open_stream(purl):
+                return ORJSONResponse({"ok": False, "error": "busy"}, status_code=503, headers={"Retry-After": "5"})
+            # подписанная ссылка протухла или ссылке со страницы не хватило
+            # куки tt_chain_token — выкидываем из кэша и достаём через yt-dlp
+            if upstream.status_code == 403:
+                # на время yt-dlp слот не держим
+                await release()
+                await invalidate(url)
+                vurl, _, cd = await extract_cached(url, use_page=False)
+                if not vurl:
+                    return ORJSONResponse({"ok": False, "error": "no_video"}, status_code=404)
+                purl = proxied(vurl)
+                if not await open_stream(purl):
+                    return ORJSONResponse({"ok": False, "error": "busy"}, status_code=503, headers={"Retry-After": "5"})
+            ctype = upstream.headers.get("content-type", "video/mp4")
+
+            # Целый файл (200) заодно пишем на диск: повтор отдадим без CDN
+            clen = upstream.headers.get("content-length", "")
+            if upstream.status_code == 200 and clen.isdigit() and "content-encoding" not in upstream.headers:
+                sink = BodySink.create(key, int(clen), cd)
 
             async def gen():
+                nonlocal sink
                 try:
-                    async for chunk in upstream.aiter_bytes():
+                    async for chunk in upstream.aiter_raw(STREAM_CHUNK_BYTES):
+                        if sink is not None:
+                            try:
+                                await sink.write(chunk)
+                            except OSError:
+                                # диск не должен ломать отдачу клиенту
+                                sink.close()
+                                sink = None
                         yield chunk
                 finally:
-                    await upstream.aclose()
+                    await release()
+
+            status = upstream.status_code
+            resp = StreamingResponse(gen(), status_code=status, media_type=ctype, background=BackgroundTask(release))
 
-        status = upstream.status_code
-        resp = StreamingResponse(gen(), status_code=status, media_type=ctype)
+            # Имя файла
+            resp.headers["Content-Disposition"] = cd
 
-        # Имя файла
-        fn_ascii, fn_utf8 = safe_filename(title)
-        resp.headers["Content-Disposition"] = (
-            f'inline; filename="{fn_ascii}"; filename*=UTF-8\'\'{urlquote(fn_utf8)}'
-        )
+            # Пробрасываем важные заголовки — один проход по сырому списку апстрима
+            for k, v in upstream.headers.raw:
+                k = k.lower()
+                if k in _PASS_HEADERS:
+                    resp.raw_headers.append((k, v))
 
-        # Пробрасываем важные заголовки
-        for h in ["content-length", "content-range", "accept-ranges", "etag", "last-modified", "cache-control"]:
-            if h in upstream.headers:
-                resp.headers[h] = upstream.headers[h]
+            # CDN почти всегда отдаёт длину прямо в GET; пробуем узнать её, только если
+            # её нет, иначе отдаём chunked — буферизовать тело ради длины не нужно.
+            # У ошибки апстрима своё тело — длину ролика к нему не приклеиваем
+            if 200 <= status < 300 and "content-length" not in resp.headers and not range_h:
+                clen = await probe_length(purl)
+                if clen:
+                    resp.headers["Content-Length"] = clen
 
-        # Если HEAD дал длину, а апстрим не дал — подставим
-        if "content-length" not in resp.headers and clen and "range" not in request.headers:
-            resp.headers["Content-Length"] = clen
+            resp.headers.setdefault("Accept-Ranges", "bytes")
+            # ошибку апстрима (тот же 403) фронтовым кэшам на сутки не отдаём
+            if status < 300:
+                resp.headers.setdefault("Cache-Control", "public, max-age=86400")
+            else:
+                resp.headers.setdefault("Cache-Control", "no-store")
 
-        resp.headers.setdefault("Accept-Ranges", "bytes")
-        resp.headers.setdefault("Cache-Control", "public, max-age=86400")
-        return resp
+            # Плеер начал с куска из середины — целиком качаем в фоне,
+            # следующие куски отдадим с диска
+            if range_h and upstream.status_code < 300:
+                start_prefetch(key, purl, cd)
+            handed_off = True
+            return resp
+        finally:
+            if not handed_off:
+                await release()
 
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)